@@ -1,7 +1,7 @@
 import glob
+import fnmatch
 import os
 import sys
-import carla
 import argparse
 import math
 import random
@@ -11,15 +11,84 @@ import queue
 import datetime
 import threading
 import weakref
+import collections
+import http.server
 import json
-
-try: 
-    sys.path.append(glob.glob('**/carla-*%d.%d-%s.egg' % ( 
-    sys.version_info.major, 
-    sys.version_info.minor, 
-    'win-amd64' if os.name == 'nt' else 'linux-x86_64'))[0]) 
-except IndexError: 
-    pass
+import sqlite3
+import struct
+import shutil
+import numpy as np
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+#carla is imported on first use by importCarla(), so --plan runs without it.
+carla = None
+
+#Synchronous mode step used by every capture pass, set from --delta.
+fixedDeltaSeconds = 0.10
+#Time run after the replay starts to skip the spawn animation, and the time left unused at the end of the log.
+spawnSkipSeconds = 2.0
+logTailSeconds = 2.0
+
+def spawnSkipTicks():
+    return int(round(spawnSkipSeconds / fixedDeltaSeconds))
+
+#A warm start instead begins the replay this far in. Both modes, in runGPS and runCondition alike, then run
+#one tick to find the ego vehicle and one after attaching sensors, so capture starts at the same replay time.
+def warmStartSeconds():
+    return spawnSkipTicks() * fixedDeltaSeconds
+
+#Number of ticks captured from a log of logFrames recorder frames (recorded at 20 Hz).
+def captureTickCount(logFrames):
+    captureSeconds = logFrames / 20.0 - spawnSkipSeconds - logTailSeconds
+    return max(0, int(captureSeconds / fixedDeltaSeconds + 1e-6))
+
+#Waits until a callback sensor has reported worldFrame, so a value is never read from the previous tick.
+def waitForFrame(sensor, worldFrame, timeout=1.0):
+    deadline = time.time() + timeout
+    while sensor.latestFrame < worldFrame and time.time() < deadline:
+        time.sleep(0.001)
+    return sensor.latestFrame >= worldFrame
+
+#The egg is taken from CARLA_EGG if set, otherwise from the path cached by an earlier run, and only
+#searched for when neither exists - the search result is then cached for next time. A cached egg built
+#for another Python version or platform is ignored and searched for again.
+eggCacheFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.carla_egg_path')
+eggPattern = 'carla-*%d.%d-%s.egg' % (
+    sys.version_info.major,
+    sys.version_info.minor,
+    'win-amd64' if os.name == 'nt' else 'linux-x86_64')
+
+def findCarlaEgg():
+    if os.environ.get('CARLA_EGG'):
+        return os.environ['CARLA_EGG']
+    if os.path.isfile(eggCacheFile):
+        with open(eggCacheFile) as infile:
+            eggPath = infile.read().strip()
+        if os.path.isfile(eggPath) and fnmatch.fnmatch(os.path.basename(eggPath), eggPattern):
+            return eggPath
+    try: 
+        eggPath = os.path.abspath(glob.glob('**/' + eggPattern)[0]) 
+    except IndexError: 
+        return None
+    try:
+        with open(eggCacheFile, 'w') as outfile:
+            outfile.write(eggPath)
+    except OSError:
+        pass
+    return eggPath
+
+def importCarla():
+    global carla
+    if carla is None:
+        eggPath = findCarlaEgg()
+        if eggPath is not None:
+            sys.path.append(eggPath)
+        import carla as carlaModule
+        carla = carlaModule
+    return carla
 
 ###########################################################
 #
@@ -27,15 +96,69 @@ except IndexError:
 #
 ###########################################################
 
+#Fixed-dtype records for the full-rate IMU and GNSS streams.
+imuDtype = np.dtype([('frame', np.int64), ('timestamp', np.float64), ('accelerometer', np.float32, (3,)), ('gyroscope', np.float32, (3,)), ('compass', np.float32)])
+gnssDtype = np.dtype([('frame', np.int64), ('timestamp', np.float64), ('latitude', np.float64), ('longitude', np.float64), ('altitude', np.float64)])
+
+#Preallocated ring of records. There is one producer (the sensor callback) and one consumer (the capture
+#loop) - the producer fills a slot before advancing writeCount, so neither side needs a lock.
+class sensorRingBuffer(object):
+    def __init__(self, dtype, capacity):
+        self.buffer = np.zeros(capacity, dtype=dtype)
+        self.capacity = capacity
+        self.writeCount = 0
+        self.readCount = 0
+        self.overruns = 0
+        self.fp = None
+
+    def push(self, record):
+        self.buffer[self.writeCount % self.capacity] = record
+        self.writeCount = self.writeCount + 1
+
+    #Returns every record written since the last drain, oldest first.
+    def drain(self):
+        end = self.writeCount
+        start = self.readCount
+        if end - start > self.capacity:
+            self.overruns = self.overruns + (end - start - self.capacity)
+            start = end - self.capacity
+        self.readCount = end
+        return self.buffer[np.arange(start, end) % self.capacity]
+
+    #Records are appended as raw bytes, the .json beside the file gives the dtype to read them back with.
+    def open_stream(self, filename):
+        self.fp = open(filename, 'wb')
+        with open(filename[:-len('.bin')] + '.json', 'w') as outfile:
+            json.dump({"dtype": self.buffer.dtype.descr}, outfile)
+
+    #Returns the number of bytes written.
+    def flush(self):
+        if self.fp is None:
+            return 0
+        data = self.drain().tobytes()
+        self.fp.write(data)
+        return len(data)
+
+    def close(self):
+        if self.fp is None:
+            return
+        self.flush()
+        self.fp.close()
+        self.fp = None
+        if self.overruns > 0:
+            print("Warning: %i stream records were overwritten before being flushed." % self.overruns)
+
 class IMUSensor(object):
-    def __init__(self, parent_actor):
+    def __init__(self, parent_actor, sensorTick=0.0, capacity=4096):
         self.sensor = None
         self._parent = parent_actor
-        self.accelerometer = (0.0, 0.0, 0.0)
-        self.gyroscope = (0.0, 0.0, 0.0)
-        self.compass = 0.0
+        #Latest sample as one tuple so data() never mixes values from two callbacks.
+        self.latest = ((0.0, 0.0, 0.0), (0.0, 0.0, 0.0), 0.0)
+        self.latestFrame = -1
+        self.stream = sensorRingBuffer(imuDtype, capacity)
         world = self._parent.get_world()
         bp = world.get_blueprint_library().find('sensor.other.imu')
+        bp.set_attribute('sensor_tick', str(sensorTick))
         self.sensor = world.spawn_actor(
             bp, carla.Transform(), attach_to=self._parent)
         # We need to pass the lambda a weak reference to self to avoid circular
@@ -50,34 +173,41 @@ class IMUSensor(object):
         if not self:
             return
         limits = (-99.9, 99.9)
-        self.accelerometer = (
+        accelerometer = (
             max(limits[0], min(limits[1], sensor_data.accelerometer.x)),
             max(limits[0], min(limits[1], sensor_data.accelerometer.y)),
             max(limits[0], min(limits[1], sensor_data.accelerometer.z)))
-        self.gyroscope = (
+        gyroscope = (
             max(limits[0], min(limits[1], math.degrees(sensor_data.gyroscope.x))),
             max(limits[0], min(limits[1], math.degrees(sensor_data.gyroscope.y))),
             max(limits[0], min(limits[1], math.degrees(sensor_data.gyroscope.z))))
-        self.compass = math.degrees(sensor_data.compass)
+        compass = math.degrees(sensor_data.compass)
+        self.stream.push((sensor_data.frame, sensor_data.timestamp, accelerometer, gyroscope, compass))
+        self.latest = (accelerometer, gyroscope, compass)
+        self.latestFrame = sensor_data.frame
 
     def data(self):
+        accelerometer, gyroscope, compass = self.latest
         returnList = []
-        returnList.append(self.accelerometer)
-        returnList.append(self.gyroscope)
-        returnList.append(self.compass)
+        returnList.append(accelerometer)
+        returnList.append(gyroscope)
+        returnList.append(compass)
         return returnList
 
     def destroy(self):
         self.sensor.destroy()
+        self.stream.close()
 
 class GnssSensor(object):
-    def __init__(self, parent_actor):
+    def __init__(self, parent_actor, sensorTick=0.0, capacity=4096):
         self.sensor = None
         self._parent = parent_actor
-        self.lat = 0.0
-        self.lon = 0.0
+        self.latest = (0.0, 0.0)
+        self.latestFrame = -1
+        self.stream = sensorRingBuffer(gnssDtype, capacity)
         world = self._parent.get_world()
         bp = world.get_blueprint_library().find('sensor.other.gnss')
+        bp.set_attribute('sensor_tick', str(sensorTick))
         self.sensor = world.spawn_actor(bp, carla.Transform(carla.Location(x=1.0, z=2.8)), attach_to=self._parent)
         # We need to pass the lambda a weak reference to self to avoid circular
         # reference.
@@ -89,32 +219,439 @@ class GnssSensor(object):
         self = weak_self()
         if not self:
             return
-        self.lat = event.latitude
-        self.lon = event.longitude
+        self.stream.push((event.frame, event.timestamp, event.latitude, event.longitude, event.altitude))
+        self.latest = (event.latitude, event.longitude)
+        self.latestFrame = event.frame
 
     def data(self):
-        returnList = [self.lat, self.lon]
+        lat, lon = self.latest
+        returnList = [lat, lon]
         return returnList
 
     def destroy(self):
         self.sensor.destroy()
+        self.stream.close()
 
-def saveGPStoFile(imuList, gpsList, frameNumber, filePrefix):
+def saveGPStoFile(imuList, gpsList, frameNumber, filePrefix, index=None, logFileName='', timestamp=0.0, stats=None):
     filename = '%s/%06d.txt' % (filePrefix, frameNumber)
     #Using JSON dict method
     jsonDict = {"Accelerometer": imuList[0], "Gyroscope": imuList[1], "Compass": imuList[2], "Latitude": gpsList[0], "Longitude": gpsList[1]}
     with open(filename, 'w') as outfile:
         json.dump(jsonDict, outfile)
+        size = outfile.tell()
+    if index is not None:
+        index.add(logFileName, 'GPS', 'GPS', 'gps', frameNumber, timestamp, filename, 0, size)
+    if stats is not None:
+        stats.addFix(gpsList[0], gpsList[1])
+    return size
+
+###########################################################
+#
+# FRAME INDEX - append-only sqlite index of every file written,
+# so datasets can be queried without walking the output tree.
+#
+###########################################################
+
+class frameIndex:
+    def __init__(self, filename, roots=None):
+        self.root = os.path.dirname(os.path.abspath(filename))
+        if roots is None:
+            roots = [self.root]
+        self.lock = threading.Lock()
+        self.pending = []
+        self.poses = collections.OrderedDict()
+        #check_same_thread is off since the saver threads add rows - all access goes through self.lock.
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS frames ('
+            'log TEXT, condition TEXT, camera TEXT, sensor_type TEXT, frame INTEGER, '
+            'sim_time REAL, path TEXT, offset INTEGER, size INTEGER, '
+            'x REAL, y REAL, z REAL, pitch REAL, yaw REAL, roll REAL, root INTEGER)')
+        #Paths are stored relative to the output root they were written to. The roots table holds each root
+        #relative to the index (absolute if on another drive) - rows with a NULL root are relative to the index.
+        self.conn.execute('CREATE TABLE IF NOT EXISTS roots (id INTEGER PRIMARY KEY, path TEXT UNIQUE)')
+        if 'root' not in [column[1] for column in self.conn.execute('PRAGMA table_info(frames)')]:
+            self.conn.execute('ALTER TABLE frames ADD COLUMN root INTEGER')
+        self.roots = []
+        for root in roots:
+            root = os.path.abspath(root)
+            try:
+                rootPath = os.path.relpath(root, self.root)
+            except ValueError:
+                rootPath = root
+            self.conn.execute('INSERT OR IGNORE INTO roots (path) VALUES (?)', (rootPath,))
+            rootId = self.conn.execute('SELECT id FROM roots WHERE path = ?', (rootPath,)).fetchone()[0]
+            self.roots.append((os.path.normcase(root), rootId))
+        #Longest first, so a root nested inside another is matched before it.
+        self.roots.sort(key=lambda root: len(root[0]), reverse=True)
+        #One row per (log, condition, camera, frame) - rows from indexes written before the key existed
+        #are deduplicated once, keeping the newest, so the unique index can be created.
+        if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'frames_key'").fetchone() is None:
+            self.conn.execute('DROP INDEX IF EXISTS frames_lookup')
+            self.conn.execute('DELETE FROM frames WHERE rowid NOT IN (SELECT MAX(rowid) FROM frames GROUP BY log, condition, camera, frame)')
+            self.conn.execute('CREATE UNIQUE INDEX frames_key ON frames (log, condition, camera, frame)')
+        self.conn.commit()
+
+    #Returns (root id, path relative to it). A file outside every root is kept as an absolute path.
+    def rootPath(self, filename):
+        filename = os.path.abspath(filename)
+        for root, rootId in self.roots:
+            if os.path.normcase(filename).startswith(os.path.join(root, '')):
+                return rootId, filename[len(os.path.join(root, '')):]
+        return None, filename
+
+    #Rows are held until flush() so the ego pose for the tick can be added to all of them at once.
+    def add(self, logName, condName, camera, sensorType, frameNumber, timestamp, filename, offset, size):
+        rootId, path = self.rootPath(filename)
+        with self.lock:
+            self.pending.append((logName, condName, camera, sensorType, frameNumber, timestamp, path, offset, size, rootId))
+
+    #The pose is remembered for frameNumber, so rows saved late (under an earlier frame) still get
+    #the pose of the frame they were taken on.
+    def flush(self, transform=None, frameNumber=None):
+        noPose = (None, None, None, None, None, None)
+        with self.lock:
+            if transform is not None and frameNumber is not None:
+                self.poses[frameNumber] = (transform.location.x, transform.location.y, transform.location.z,
+                                           transform.rotation.pitch, transform.rotation.yaw, transform.rotation.roll)
+                while len(self.poses) > 1000:
+                    self.poses.popitem(last=False)
+            rows = [row[:9] + self.poses.get(row[4], noPose) + row[9:] for row in self.pending]
+            self.pending = []
+            if len(rows) > 0:
+                self.conn.executemany(
+                    'INSERT OR REPLACE INTO frames (log, condition, camera, sensor_type, frame, sim_time, path, offset, size, '
+                    'x, y, z, pitch, yaw, roll, root) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+                self.conn.commit()
+
+    #Used before a condition runs, so a rerun or retry into the same --dir does not keep rows for frames it no longer writes.
+    def removeCondition(self, logName, condName):
+        with self.lock:
+            self.pending = []
+            self.poses.clear()
+            if condName == 'GPS':
+                self.conn.execute('DELETE FROM frames WHERE log = ? AND condition IN (?, ?)', (logName, 'GPS', 'PointCloud'))
+            else:
+                self.conn.execute('DELETE FROM frames WHERE log = ? AND condition = ?', (logName, condName))
+            self.conn.commit()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.conn.close()
     
+###########################################################
+#
+# CAPTURE METRICS - live throughput counters, served in
+# Prometheus text format and printed to stderr periodically.
+#
+###########################################################
+
+class captureMetrics:
+    def __init__(self, interval):
+        self.lock = threading.Lock()
+        self.interval = interval
+        self.lastReport = time.time()
+        self.condition = ''
+        self.framesDone = 0
+        self.framesTotal = 0
+        self.conditionsDone = 0
+        self.sensorList = []
+        self.tickTimes = collections.deque(maxlen=50)
+        #(time, bytesWritten) samples over the last rateWindow seconds, for the write rate.
+        self.rateWindow = 10.0
+        self.byteSamples = collections.deque()
+        self.bytesWritten = 0
+        self.droppedFrames = 0
+        self.staleFrames = 0
+        self.server = None
+
+    def startCondition(self, condName, framesTotal, sensorList):
+        with self.lock:
+            self.condition = condName
+            self.framesDone = 0
+            self.framesTotal = framesTotal
+            self.sensorList = list(sensorList)
+            self.tickTimes.clear()
+
+    def endCondition(self):
+        with self.lock:
+            self.conditionsDone = self.conditionsDone + 1
+            self.sensorList = []
+
+    def addWrite(self, numBytes):
+        with self.lock:
+            self.bytesWritten = self.bytesWritten + numBytes
+
+    def addDropped(self):
+        with self.lock:
+            self.droppedFrames = self.droppedFrames + 1
+
+    def addStale(self):
+        with self.lock:
+            self.staleFrames = self.staleFrames + 1
+
+    def frameDone(self):
+        with self.lock:
+            self.framesDone = self.framesDone + 1
+            self.tickTimes.append(time.time())
+            self.sampleBytes(time.time())
+        if self.interval > 0 and time.time() - self.lastReport >= self.interval:
+            self.lastReport = time.time()
+            self.report()
+
+    #Called with self.lock held. The oldest sample kept is the last one at or before the window start.
+    def sampleBytes(self, now):
+        self.byteSamples.append((now, self.bytesWritten))
+        while len(self.byteSamples) > 2 and now - self.byteSamples[1][0] >= self.rateWindow:
+            self.byteSamples.popleft()
+
+    #Rates are taken over the recent window so a stall shows up straight away.
+    def values(self):
+        with self.lock:
+            now = time.time()
+            ticksPerSecond = 0.0
+            if len(self.tickTimes) > 1:
+                ticksPerSecond = (len(self.tickTimes) - 1) / max(now - self.tickTimes[0], 1e-6)
+            self.sampleBytes(now)
+            startTime, startBytes = self.byteSamples[0]
+            writeBytesPerSecond = 0.0
+            if now - startTime > 0:
+                writeBytesPerSecond = (self.bytesWritten - startBytes) / (now - startTime)
+            eta = -1.0
+            if ticksPerSecond > 0:
+                eta = (self.framesTotal - self.framesDone) / ticksPerSecond
+            queueDepths = [(sensor.name, sensor.queueDepth()) for sensor in self.sensorList]
+            return {"condition": self.condition, "framesDone": self.framesDone, "framesTotal": self.framesTotal,
+                    "conditionsDone": self.conditionsDone, "ticksPerSecond": ticksPerSecond,
+                    "writeBytesPerSecond": writeBytesPerSecond, "bytesWritten": self.bytesWritten,
+                    "droppedFrames": self.droppedFrames, "staleFrames": self.staleFrames, "eta": eta, "queueDepths": queueDepths}
+
+    def prometheusText(self):
+        v = self.values()
+        lines = []
+        lines.append('capture_condition_info{condition="%s"} 1' % v["condition"])
+        lines.append('capture_frames_done %i' % v["framesDone"])
+        lines.append('capture_frames_total %i' % v["framesTotal"])
+        lines.append('capture_conditions_done %i' % v["conditionsDone"])
+        lines.append('capture_ticks_per_second %f' % v["ticksPerSecond"])
+        lines.append('capture_write_bytes_per_second %f' % v["writeBytesPerSecond"])
+        lines.append('capture_bytes_written_total %i' % v["bytesWritten"])
+        lines.append('capture_dropped_frames_total %i' % v["droppedFrames"])
+        lines.append('capture_stale_frames_total %i' % v["staleFrames"])
+        lines.append('capture_eta_seconds %f' % v["eta"])
+        for name, depth in v["queueDepths"]:
+            lines.append('capture_queue_depth{sensor="%s"} %i' % (name, depth))
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        v = self.values()
+        queues = " ".join(["%s=%i" % (name, depth) for name, depth in v["queueDepths"]])
+        sys.stderr.write("[%s] %s: frame %i/%i, %.2f ticks/s, %.1f MB/s, dropped %i, stale %i, ETA %.0f s, queues %s\n" % (
+            datetime.datetime.now().strftime('%H:%M:%S'), v["condition"], v["framesDone"], v["framesTotal"], v["ticksPerSecond"],
+            v["writeBytesPerSecond"] / 1e6, v["droppedFrames"], v["staleFrames"], v["eta"], queues))
+
+    def serve(self, port):
+        metrics = self
+        class metricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheusText().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                return
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), metricsHandler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+###########################################################
+#
+# WATCHDOG - detects stalled ticks from recent tick latency and
+# reconnects to the simulator so a failed condition can be retried.
+#
+###########################################################
+
+class simulatorStalled(Exception):
+    pass
+
+#Same as the CARLA client's own default timeout.
+startTickTimeout = 10.0
+
+class tickWatchdog:
+    def __init__(self, maxTimeout, minTimeout, stallFactor):
+        self.maxTimeout = maxTimeout
+        self.minTimeout = minTimeout
+        self.stallFactor = stallFactor
+        self.latencies = collections.deque(maxlen=50)
+
+    #Latencies from before a map (re)load say nothing about the new one.
+    def reset(self):
+        self.latencies.clear()
+
+    #Until enough ticks have been seen startTickTimeout is used, after that a tick is stalled
+    #once it takes stallFactor times longer than the recent median.
+    def timeout(self):
+        if len(self.latencies) < 10:
+            return min(self.maxTimeout, startTickTimeout)
+        median = sorted(self.latencies)[int(len(self.latencies) / 2)]
+        return min(self.maxTimeout, max(self.minTimeout, self.stallFactor * median))
+
+    def tick(self, world):
+        timeout = self.timeout()
+        startTime = time.time()
+        try:
+            frame = world.tick(timeout)
+        except RuntimeError as e:
+            raise simulatorStalled("No tick within %.1f s: %s" % (timeout, e))
+        self.latencies.append(time.time() - startTime)
+        return frame
+
+def tickWorld(client, watchdog=None):
+    if watchdog is None:
+        return client.get_world().tick()
+    return watchdog.tick(client.get_world())
+
+#Best effort - the server may be gone, in which case there is nothing to restore.
+def restoreAsync(client):
+    try:
+        settings = client.get_world().get_settings()
+        settings.synchronous_mode = False
+        settings.fixed_delta_seconds = 0
+        client.get_world().apply_settings(settings)
+        return True
+    except RuntimeError:
+        return False
+
+class simulatorSession:
+    def __init__(self, host, port, timeout, reconnectWait, watchdog=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reconnectWait = reconnectWait
+        self.watchdog = watchdog
+        self.logMap = None
+        self.client = carla.Client(host, port)
+        self.client.set_timeout(timeout)
+
+    def loadMap(self, logMap):
+        self.logMap = logMap
+        self.client.load_world(logMap)
+        if self.watchdog is not None:
+            self.watchdog.reset()
+
+    #Restores async settings, then waits for the server to answer (it may be restarting) and reloads the map.
+    #The old client is likely hung, so it only gets a short timeout for the restore.
+    def reconnect(self):
+        self.client.set_timeout(2.0)
+        restoreAsync(self.client)
+        deadline = time.time() + self.reconnectWait
+        while True:
+            try:
+                client = carla.Client(self.host, self.port)
+                client.set_timeout(10.0)
+                client.get_server_version()
+                restoreAsync(client)
+                client.set_timeout(self.timeout)
+                if self.logMap is not None:
+                    client.load_world(self.logMap)
+                self.client = client
+                if self.watchdog is not None:
+                    self.watchdog.reset()
+                return
+            except RuntimeError as e:
+                if time.time() > deadline:
+                    raise
+                print("Waiting for simulator at %s:%i (%s)" % (self.host, self.port, e))
+                time.sleep(5)
+
+#Runs a condition, reconnecting and retrying it up to retries more times if the simulator stalls or drops.
+def runWithRetry(condName, run, session, retries, index=None, logFileName=''):
+    for attempt in range(0, retries + 1):
+        if index is not None:
+            index.removeCondition(logFileName, condName)
+        try:
+            run(session.client)
+            return True
+        except (RuntimeError, simulatorStalled) as e:
+            print("Condition %s failed on attempt %i of %i at %s: %s" % (condName, attempt + 1, retries + 1, datetime.datetime.now(), e))
+            if attempt < retries:
+                session.reconnect()
+    print("Error: giving up on condition %s." % condName)
+    return False
+
+###########################################################
+#
+# OUTPUT PLACEMENT - spreads sensor output over several roots
+# (disks), so write bandwidth scales with the number of disks.
+#
+###########################################################
+
+placementPolicies = ['round_robin', 'least_loaded']
+
+class outputPlacer:
+    def __init__(self, roots, policy):
+        self.roots = roots
+        self.primary = roots[0]
+        self.policy = policy
+        self.counter = 0
+        self.placed = {}
+        self.active = dict((root, 0) for root in roots)
+
+    #Called at the start of each pass - sensors already placed on a root count against it until then.
+    def startCondition(self):
+        self.active = dict((root, 0) for root in self.roots)
+
+    #least_loaded picks the root with the least expected write load (sensorWriteWeight) in this pass, then the
+    #most free space. Sensors are placed before they start listening, so there are no queue depths to go on yet.
+    def rootFor(self, key, weight=1.0):
+        if key in self.placed:
+            return self.placed[key]
+        if self.policy == 'least_loaded':
+            root = min(self.roots, key=lambda root: (self.active[root], -freeSpace(root)))
+        else:
+            root = self.roots[self.counter % len(self.roots)]
+            self.counter = self.counter + 1
+        self.active[root] = self.active[root] + weight
+        self.placed[key] = root
+        return root
+
+def freeSpace(root):
+    try:
+        return shutil.disk_usage(root).free
+    except OSError:
+        return 0
+
+#Output directories may be given as a single root or an outputPlacer.
+def placeOutput(dirname, key, weight=1.0):
+    if isinstance(dirname, outputPlacer):
+        return dirname.rootFor(key, weight)
+    return dirname
+
+def primaryRoot(dirname):
+    if isinstance(dirname, outputPlacer):
+        return dirname.primary
+    return dirname
+
 ##############################################################
 #
 #   RUN_GPS
 #
 ##############################################################
-def runGPS(logFile, logFileName, logFrames, outputDir, client):
+def runGPS(logFile, logFileName, logFrames, outputDir, sensorFile, client, index=None, metrics=None, watchdog=None, imuTick=0.0, warmStart=False, collectStats=False):
 
     #Make the GPS directory if it doesn't already exist.
-    dirPrefix = '%s/%s/GPS' % (outputDir, logFileName)
+    dirPrefix = '%s/%s/GPS' % (primaryRoot(outputDir), logFileName)
     cwd = os.getcwd()
     path = os.path.join(cwd, dirPrefix)
     if not(os.path.exists(path)):
@@ -123,15 +660,20 @@ def runGPS(logFile, logFileName, logFrames, outputDir, client):
     #Turn on synchronous mode
     settings = client.get_world().get_settings()
     settings.synchronous_mode = True
-    settings.fixed_delta_seconds = 0.10
+    settings.fixed_delta_seconds = fixedDeltaSeconds
     client.get_world().apply_settings(settings)
 
-    for i in range(0,5):
-        client.get_world().tick()
-
-    #Replay the log file
-    client.replay_file(logFile, 0, 0, 0)
-    client.get_world().tick()
+    if warmStart:
+        #Start the replay past the spawn animation - one tick is enough to apply the settings.
+        tickWorld(client, watchdog)
+        client.replay_file(logFile, warmStartSeconds(), 0, 0)
+    else:
+        for i in range(0,5):
+            tickWorld(client, watchdog)
+
+        #Replay the log file
+        client.replay_file(logFile, 0, 0, 0)
+    tickWorld(client, watchdog)
     actorList = client.get_world().get_actors()
 
     #Find the hero vehicle and attach the sensors.
@@ -145,23 +687,69 @@ def runGPS(logFile, logFileName, logFrames, outputDir, client):
         print("Error: Could not find the ego vehicle!")
         return
     
-    #Create GPS and IMU sensor.
-    gpsSensor = GnssSensor(egoVehicle)
-    imuSensor = IMUSensor(egoVehicle)
-
-    #20 ticks to skip spawn animation - in sync with the rgb runCondition.
-    for i in range(0, 20):
-        client.get_world().tick()
-
-    #Sleep here is required to prevent buffering problem - buffer will read from previous step rather than current.
-    time.sleep(2)
+    #Create GPS and IMU sensor, and any lidar/radar in the .cam file.
+    gpsSensor = GnssSensor(egoVehicle, imuTick)
+    imuSensor = IMUSensor(egoVehicle, imuTick)
+    pointCloudSensorList = pointCloudSensorCreator(sensorFile, egoVehicle, client, outputDir, logFileName, index)
+    if pointCloudSensorList is None:
+        pointCloudSensorList = []
+
+    #Same post-attach tick as runCondition, so GPS record N and camera frame N share a replay time.
+    tickWorld(client, watchdog)
+
+    if not warmStart:
+        #20 ticks to skip spawn animation - in sync with the rgb runCondition.
+        for i in range(0, spawnSkipTicks()):
+            tickWorld(client, watchdog)
+
+        #Sleep here is required to prevent buffering problem - buffer will read from previous step rather than current.
+        time.sleep(2)
+
+    stats = None
+    if collectStats:
+        stats = conditionStatistics()
+
+    #Start saving data - every IMU/GNSS sample from here on is kept in the streams, flushed in bulk.
+    gpsSensor.stream.drain()
+    imuSensor.stream.drain()
+    gpsSensor.stream.open_stream('%s/gnss.bin' % dirPrefix)
+    imuSensor.stream.open_stream('%s/imu.bin' % dirPrefix)
+    for sensor in pointCloudSensorList:
+        sensor.set_metrics(metrics)
+        sensor.listen()
+    captureTicks = captureTickCount(logFrames)
+    if metrics is not None:
+        metrics.startCondition('GPS', captureTicks, pointCloudSensorList)
 
-    #Start saving data.
     #Wait for the running log to finish
-    for frameNumber in range (0,int(logFrames/2)-40):
-        client.get_world().tick()
-        saveGPStoFile(imuSensor.data(), gpsSensor.data(), frameNumber, dirPrefix)
+    for frameNumber in range (0,captureTicks):
+        worldFrame = tickWorld(client, watchdog)
+        timestamp = client.get_world().get_snapshot().timestamp.elapsed_seconds
+        if imuTick <= 0:
+            waitForFrame(imuSensor, worldFrame)
+            waitForFrame(gpsSensor, worldFrame)
+        size = saveGPStoFile(imuSensor.data(), gpsSensor.data(), frameNumber, dirPrefix, index, logFileName, timestamp, stats)
+        if metrics is not None:
+            metrics.addWrite(size)
+        for sensor in pointCloudSensorList:
+            sensor.saveData(frameNumber, worldFrame)
+        if frameNumber % 100 == 99:
+            size = gpsSensor.stream.flush() + imuSensor.stream.flush()
+            if metrics is not None:
+                metrics.addWrite(size)
+        if index is not None:
+            index.flush(egoVehicle.get_transform(), frameNumber)
+        if metrics is not None:
+            metrics.frameDone()
         #imageSaver(sensorList, frameNumber, int(threadNumber))
+    if captureTicks > 0:
+        for sensor in pointCloudSensorList:
+            sensor.saveLate(captureTicks - 1)
+    size = gpsSensor.stream.flush() + imuSensor.stream.flush()
+    if metrics is not None:
+        metrics.addWrite(size)
+    if index is not None:
+        index.flush()
 
     #Destroy the cameras - required since the car they are attached to is deleted on replay.
     #World should be asynchronous again - speed increase since no more data is collected.
@@ -170,8 +758,204 @@ def runGPS(logFile, logFileName, logFrames, outputDir, client):
     settings.fixed_delta_seconds = 0
     client.get_world().apply_settings(settings)
 
+    if metrics is not None:
+        metrics.endCondition()
+    if stats is not None:
+        stats.save('%s/stats.json' % dirPrefix)
     imuSensor.destroy()
     gpsSensor.destroy()
+    for sensor in pointCloudSensorList:
+        sensor.destroy()
+
+###########################################################
+#
+# SENSOR SCHEDULING - sensors with a sensor_tick do not fire on
+# every world tick, so each measurement is saved under the capture
+# frame number of the world frame it was taken on.
+#
+###########################################################
+
+#Returns every measurement that has arrived, and whether the one for worldFrame was among them. With
+#wait set (a sensor that fires every tick) this blocks until the worldFrame measurement is in. Otherwise
+#it never blocks - a measurement that arrives late is returned by a later call and saved under its own frame.
+def pendingSensorData(dataQueue, worldFrame, wait, timeout=1.0):
+    measurements = []
+    haveCurrent = False
+    while True:
+        try:
+            if wait and not haveCurrent:
+                data = dataQueue.get(timeout=timeout)
+            else:
+                data = dataQueue.get_nowait()
+        except queue.Empty:
+            return measurements, haveCurrent
+        measurements.append(data)
+        if data.frame >= worldFrame:
+            haveCurrent = True
+
+#Sensors with a sensor_tick are never waited on, so anything still in flight when the pass ends is
+#collected here - frames after lastFrame are ignored.
+def lateSensorData(dataQueue, timeout=0.5):
+    measurements = []
+    while True:
+        try:
+            measurements.append(dataQueue.get(timeout=timeout))
+        except queue.Empty:
+            return measurements
+
+###########################################################
+#
+# IMAGE PROCESSING - vectorized crop and resize of raw BGRA
+# camera buffers before they are encoded.
+#
+###########################################################
+
+depthPools = ['min', 'median']
+#Camera blueprint image size when the .cam line gives no width or height.
+defaultImageSize = (800, 600)
+
+def imageToArray(image):
+    return np.frombuffer(image.raw_data, dtype=np.uint8).reshape(image.height, image.width, 4)
+
+def cropArray(array, crop):
+    x, y, width, height = crop
+    return array[y:y+height, x:x+width]
+
+def resizeNearest(array, width, height):
+    rows = (np.arange(height) * array.shape[0] / height).astype(np.int64)
+    cols = (np.arange(width) * array.shape[1] / width).astype(np.int64)
+    return array[rows][:, cols]
+
+#Block average when the size divides evenly, otherwise PIL's box filter does the same with fractional blocks.
+def resizeArea(array, width, height):
+    if array.shape[0] % height == 0 and array.shape[1] % width == 0:
+        blocks = array.reshape(height, array.shape[0] // height, width, array.shape[1] // width, array.shape[2])
+        return blocks.mean(axis=(1, 3)).round().astype(np.uint8)
+    return np.asarray(Image.fromarray(np.ascontiguousarray(array)).resize((width, height), Image.BOX))
+
+#Normalized depth in [0, 1] from the 24 bit value CARLA packs into the R, G and B channels.
+def decodeDepth(array):
+    bgr = array[:, :, :3].astype(np.float32)
+    return (bgr[:, :, 2] + bgr[:, :, 1] * 256.0 + bgr[:, :, 0] * 65536.0) / 16777215.0
+
+#Indices of the source pixels in each of bins output pixels, padded to the widest bin, and a mask of the real ones.
+def poolBins(size, bins):
+    starts = np.arange(bins) * size // bins
+    ends = np.maximum(np.arange(1, bins + 1) * size // bins, starts + 1)
+    index = starts[:, np.newaxis] + np.arange(int((ends - starts).max()))
+    return np.minimum(index, size - 1), index < ends[:, np.newaxis]
+
+#Min (nearest surface) or median of each block - averaging depth would invent surfaces at object edges.
+#Blocks are uneven when the size does not divide, the padding is masked out with NaN.
+def poolDepth(depth, width, height, pool):
+    if depth.shape[0] % height == 0 and depth.shape[1] % width == 0:
+        blocks = depth.reshape(height, depth.shape[0] // height, width, depth.shape[1] // width)
+        if pool == 'median':
+            return np.median(blocks, axis=(1, 3))
+        return blocks.min(axis=(1, 3))
+    rows, rowMask = poolBins(depth.shape[0], height)
+    cols, colMask = poolBins(depth.shape[1], width)
+    blocks = depth[rows[:, :, np.newaxis, np.newaxis], cols[np.newaxis, np.newaxis, :, :]]
+    blocks = np.where(rowMask[:, :, np.newaxis, np.newaxis] & colMask[np.newaxis, np.newaxis, :, :], blocks, np.nan)
+    if pool == 'median':
+        return np.nanmedian(blocks, axis=(1, 3))
+    return np.nanmin(blocks, axis=(1, 3))
+
+#Same mapping as carla.ColorConverter.LogarithmicDepth, as an RGB grey image.
+def logarithmicDepth(depth):
+    logDepth = 1.0 + np.log(np.maximum(depth, 1e-12)) / 5.70378
+    grey = (np.clip(logDepth, 0.0, 1.0) * 255.0).astype(np.uint8)
+    return np.repeat(grey[:, :, np.newaxis], 3, axis=2)
+
+###########################################################
+#
+# DATASET STATISTICS - per camera summaries accumulated from the
+# buffers already in memory, written when a condition ends.
+#
+###########################################################
+
+class conditionStatistics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cameras = {}
+        self.trackLength = 0.0
+        self.fixes = 0
+        self.lastFix = None
+
+    def cameraEntry(self, camera, sensorType):
+        if camera not in self.cameras:
+            self.cameras[camera] = {"type": sensorType, "frames": 0}
+        return self.cameras[camera]
+
+    #array is the raw BGRA buffer - for seg it must be taken before the palette conversion, since the
+    #class tag is held in the red channel.
+    def addImage(self, camera, sensorType, array):
+        if sensorType == 'seg':
+            classCounts = np.bincount(array[:, :, 2].ravel(), minlength=256)
+            with self.lock:
+                entry = self.cameraEntry(camera, sensorType)
+                entry["frames"] = entry["frames"] + 1
+                entry["classCounts"] = entry.get("classCounts", 0) + classCounts
+        elif sensorType == 'depth':
+            depth = decodeDepth(array) * 1000.0
+            frameMin = float(depth.min())
+            frameMax = float(depth.max())
+            frameMean = float(depth.mean())
+            with self.lock:
+                entry = self.cameraEntry(camera, sensorType)
+                entry["frames"] = entry["frames"] + 1
+                entry["minDepth"] = min(entry.get("minDepth", frameMin), frameMin)
+                entry["maxDepth"] = max(entry.get("maxDepth", frameMax), frameMax)
+                entry["sumMeanDepth"] = entry.get("sumMeanDepth", 0.0) + frameMean
+        else:
+            #Luma is linear in the channels, so the channel means are enough.
+            blue, green, red = array[:, :, :3].reshape(-1, 3).mean(axis=0)
+            brightness = float(0.299 * red + 0.587 * green + 0.114 * blue)
+            with self.lock:
+                entry = self.cameraEntry(camera, sensorType)
+                entry["frames"] = entry["frames"] + 1
+                entry["minBrightness"] = min(entry.get("minBrightness", brightness), brightness)
+                entry["maxBrightness"] = max(entry.get("maxBrightness", brightness), brightness)
+                entry["sumBrightness"] = entry.get("sumBrightness", 0.0) + brightness
+
+    #Track length in metres along the great circle between consecutive fixes.
+    def addFix(self, lat, lon):
+        with self.lock:
+            if self.lastFix is not None:
+                lat1, lon1 = math.radians(self.lastFix[0]), math.radians(self.lastFix[1])
+                lat2, lon2 = math.radians(lat), math.radians(lon)
+                a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+                self.trackLength = self.trackLength + 2 * 6371000.0 * math.asin(math.sqrt(min(1.0, a)))
+            self.lastFix = (lat, lon)
+            self.fixes = self.fixes + 1
+
+    def summary(self):
+        with self.lock:
+            cameras = {}
+            for camera, entry in self.cameras.items():
+                frames = max(entry["frames"], 1)
+                result = {"type": entry["type"], "frames": entry["frames"]}
+                if "classCounts" in entry:
+                    counts = entry["classCounts"]
+                    result["classFractions"] = dict((str(tag), float(counts[tag]) / counts.sum()) for tag in np.nonzero(counts)[0])
+                if "sumMeanDepth" in entry:
+                    result["minDepth"] = entry["minDepth"]
+                    result["maxDepth"] = entry["maxDepth"]
+                    result["meanDepth"] = entry["sumMeanDepth"] / frames
+                if "sumBrightness" in entry:
+                    result["minBrightness"] = entry["minBrightness"]
+                    result["maxBrightness"] = entry["maxBrightness"]
+                    result["meanBrightness"] = entry["sumBrightness"] / frames
+                cameras[camera] = result
+            summary = {"cameras": cameras}
+            if self.fixes > 0:
+                summary["gpsFixes"] = self.fixes
+                summary["trackLength"] = self.trackLength
+            return summary
+
+    def save(self, filename):
+        with open(filename, 'w') as outfile:
+            json.dump(self.summary(), outfile, indent=1)
 
 ###########################################################
 #
@@ -186,24 +970,70 @@ class rgbSensor:
         self.y = 0
         self.z = 0
         self.yaw = 0
+        self.pitch = 0
+        self.roll = 0
+        self.width = 0
+        self.height = 0
+        self.fov = 0
+        self.sensorTick = 0
+        self.frameOffset = None
+        self.crop = None
+        self.resize = None
+        self.pool = 'min'
         self.imageQueue = queue.Queue()
         self._type = 'rgb'
+        self.name = ''
+        self.index = None
+        self.metrics = None
+        self.stats = None
+        self.logName = ''
+        self.condName = ''
 
     def set_meta_params(self, dirname, path, name):
+        self.name = name
         self.dirpath = '%s/%s/%s' % (dirname, path,name)
         cwd = os.getcwd()
         path = os.path.join(cwd, self.dirpath)
         if not(os.path.exists(path)):
             os.makedirs(path)
         
-    def set_params(self, x, y, z, yaw):
+    def set_params(self, x, y, z, yaw, pitch=0, roll=0):
         self.x = x
         self.y = y
         self.z = z
         self.yaw = yaw
+        self.pitch = pitch
+        self.roll = roll
+
+    #Zero leaves the blueprint default.
+    def set_sensor_params(self, width, height, fov, sensorTick):
+        self.width = width
+        self.height = height
+        self.fov = fov
+        self.sensorTick = sensorTick
+
+    #Crop (x, y, w, h) and resize (w, h) of the saved image, None keeps the full rendered image.
+    def set_output_params(self, crop, resize, pool):
+        self.crop = crop
+        self.resize = resize
+        self.pool = pool
+
+    def set_index(self, index, logName, condName):
+        self.index = index
+        self.logName = logName
+        self.condName = condName
+
+    def set_metrics(self, metrics):
+        self.metrics = metrics
+
+    def set_stats(self, stats):
+        self.stats = stats
+
+    def queueDepth(self):
+        return self.imageQueue.qsize()
 
     def attach_to_car(self, car, blueprint, world, sensorType):
-        camera_transform = carla.Transform(carla.Location(x=self.x, y=self.y, z=self.z), carla.Rotation(yaw=self.yaw))
+        camera_transform = carla.Transform(carla.Location(x=self.x, y=self.y, z=self.z), carla.Rotation(pitch=self.pitch, yaw=self.yaw, roll=self.roll))
         if sensorType == 'rgb':
             camera_bp = blueprint.find('sensor.camera.rgb') #default set to rgb
             self._type = 'rgb'
@@ -213,22 +1043,197 @@ class rgbSensor:
         elif sensorType == 'depth':
             camera_bp = blueprint.find('sensor.camera.depth')
             self._type = 'depth'
+        if self.width > 0:
+            camera_bp.set_attribute('image_size_x', str(self.width))
+        if self.height > 0:
+            camera_bp.set_attribute('image_size_y', str(self.height))
+        if self.fov > 0:
+            camera_bp.set_attribute('fov', str(self.fov))
+        camera_bp.set_attribute('sensor_tick', str(self.sensorTick))
         self.sensor = world.spawn_actor(camera_bp, camera_transform, attach_to=car)
 
     def listen(self):
         self.sensor.listen(self.imageQueue.put)
 
-    def saveImage(self,frameNumber):
-        image = self.imageQueue.get()
-        if self._type == 'seg':
-            image.convert(carla.ColorConverter.CityScapesPalette)
-        elif self._type == 'depth':
-            image.convert(carla.ColorConverter.LogarithmicDepth)
-        image.save_to_disk('%s/%06d.png' % (self.dirpath, frameNumber))
+    #Capture frame numbers advance one per world tick, so worldFrame - frameNumber maps any
+    #measurement's own frame id to the frame number it is saved under.
+    def saveImage(self, frameNumber, worldFrame):
+        self.frameOffset = worldFrame - frameNumber
+        images, haveCurrent = pendingSensorData(self.imageQueue, worldFrame, self.sensorTick <= 0)
+        if self.sensorTick <= 0 and not haveCurrent and self.metrics is not None:
+            self.metrics.addDropped()
+        for image in images:
+            self.writeImage(image)
+
+    def saveLate(self, lastFrame):
+        if self.sensorTick <= 0 or self.frameOffset is None:
+            return
+        for image in lateSensorData(self.imageQueue):
+            if image.frame - self.frameOffset <= lastFrame:
+                self.writeImage(image)
+
+    def writeImage(self, image):
+        frameNumber = image.frame - self.frameOffset
+        if frameNumber < 0:
+            #Rendered before capture started.
+            if self.metrics is not None:
+                self.metrics.addStale()
+            return
+        if self.stats is not None:
+            self.stats.addImage(self.name, self._type, imageToArray(image))
+        filename = '%s/%06d.png' % (self.dirpath, frameNumber)
+        if self.crop is None and self.resize is None:
+            if self._type == 'seg':
+                image.convert(carla.ColorConverter.CityScapesPalette)
+            elif self._type == 'depth':
+                image.convert(carla.ColorConverter.LogarithmicDepth)
+            image.save_to_disk(filename)
+        else:
+            #Depth is pooled on the decoded values before the logarithmic encoding, so it is not converted here.
+            if self._type == 'seg':
+                image.convert(carla.ColorConverter.CityScapesPalette)
+            array = imageToArray(image)
+            if self.crop is not None:
+                array = cropArray(array, self.crop)
+            if self._type == 'depth':
+                depth = decodeDepth(array)
+                if self.resize is not None:
+                    depth = poolDepth(depth, self.resize[0], self.resize[1], self.pool)
+                array = logarithmicDepth(depth)
+            else:
+                array = array[:, :, 2::-1]
+                if self.resize is not None and self._type == 'seg':
+                    array = resizeNearest(array, self.resize[0], self.resize[1])
+                elif self.resize is not None:
+                    array = resizeArea(array, self.resize[0], self.resize[1])
+            Image.fromarray(np.ascontiguousarray(array)).save(filename)
+        size = os.path.getsize(filename)
+        if self.index is not None:
+            self.index.add(self.logName, self.condName, self.name, self._type, frameNumber, image.timestamp, filename, 0, size)
+        if self.metrics is not None:
+            self.metrics.addWrite(size)
 
     def destroy(self):
         self.sensor.destroy()
 
+###########################################################
+#
+# POINT CLOUD SENSOR - lidar and radar sensors which append
+# their raw float32 measurements to one binary file per run.
+#
+###########################################################
+
+class pointCloudSensor:
+    def __init__(self):
+        self.x = 0
+        self.y = 0
+        self.z = 0
+        self.yaw = 0
+        self.pitch = 0
+        self.roll = 0
+        self.sensorTick = 0
+        self.frameOffset = None
+        self.dataQueue = queue.Queue()
+        self._type = 'lidar'
+        self.name = ''
+        self.index = None
+        self.metrics = None
+        self.logName = ''
+        self.channels = 0
+        self.offsets = []
+        self.fp = None
+
+    def set_meta_params(self, dirname, logName, name):
+        self.name = name
+        self.logName = logName
+        self.dirpath = '%s/%s/PointCloud' % (dirname, logName)
+        cwd = os.getcwd()
+        path = os.path.join(cwd, self.dirpath)
+        if not(os.path.exists(path)):
+            os.makedirs(path)
+        self.filename = '%s/%s.bin' % (self.dirpath, name)
+        self.fp = open(self.filename, 'wb')
+
+    def set_params(self, x, y, z, yaw, pitch=0, roll=0):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.yaw = yaw
+        self.pitch = pitch
+        self.roll = roll
+
+    def set_sensor_params(self, sensorTick):
+        self.sensorTick = sensorTick
+
+    def set_index(self, index):
+        self.index = index
+
+    def set_metrics(self, metrics):
+        self.metrics = metrics
+
+    def queueDepth(self):
+        return self.dataQueue.qsize()
+
+    def attach_to_car(self, car, blueprint, world, sensorType):
+        sensor_transform = carla.Transform(carla.Location(x=self.x, y=self.y, z=self.z), carla.Rotation(pitch=self.pitch, yaw=self.yaw, roll=self.roll))
+        if sensorType == 'lidar':
+            sensor_bp = blueprint.find('sensor.lidar.ray_cast')
+            #One full sweep per tick so each frame holds a complete scan.
+            delta = world.get_settings().fixed_delta_seconds
+            if delta:
+                sensor_bp.set_attribute('rotation_frequency', str(1.0 / delta))
+            self._type = 'lidar'
+        elif sensorType == 'radar':
+            sensor_bp = blueprint.find('sensor.other.radar')
+            self._type = 'radar'
+        sensor_bp.set_attribute('sensor_tick', str(self.sensorTick))
+        self.sensor = world.spawn_actor(sensor_bp, sensor_transform, attach_to=car)
+
+    def listen(self):
+        self.sensor.listen(self.dataQueue.put)
+
+    #raw_data is written as-is - it is already packed float32 (lidar x,y,z[,i], radar velocity,azimuth,altitude,depth).
+    def saveData(self, frameNumber, worldFrame):
+        self.frameOffset = worldFrame - frameNumber
+        measurements, haveCurrent = pendingSensorData(self.dataQueue, worldFrame, self.sensorTick <= 0)
+        if self.sensorTick <= 0 and not haveCurrent and self.metrics is not None:
+            self.metrics.addDropped()
+        for data in measurements:
+            self.writeData(data)
+
+    def saveLate(self, lastFrame):
+        if self.sensorTick <= 0 or self.frameOffset is None:
+            return
+        for data in lateSensorData(self.dataQueue):
+            if data.frame - self.frameOffset <= lastFrame:
+                self.writeData(data)
+
+    def writeData(self, data):
+        frameNumber = data.frame - self.frameOffset
+        if frameNumber < 0:
+            if self.metrics is not None:
+                self.metrics.addStale()
+            return
+        rawData = memoryview(data.raw_data)
+        numPoints = len(data)
+        if numPoints > 0 and self.channels == 0:
+            self.channels = int(rawData.nbytes / 4 / numPoints)
+        offset = self.fp.tell()
+        self.fp.write(rawData)
+        self.offsets.append((frameNumber, offset, numPoints))
+        if self.index is not None:
+            self.index.add(self.logName, 'PointCloud', self.name, self._type, frameNumber, data.timestamp, self.filename, offset, rawData.nbytes)
+        if self.metrics is not None:
+            self.metrics.addWrite(rawData.nbytes)
+
+    #Frame offsets are saved as an int64 (frame, byte offset, point count) array so the .bin can be memory mapped.
+    def destroy(self):
+        self.sensor.destroy()
+        self.fp.close()
+        np.save('%s/%s.offsets.npy' % (self.dirpath, self.name), np.array(self.offsets, dtype=np.int64).reshape(-1, 3))
+        with open('%s/%s.json' % (self.dirpath, self.name), 'w') as outfile:
+            json.dump({"type": self._type, "dtype": "float32", "channels": self.channels}, outfile)
+
 ###########################################################
 #
 # SENSOR CREATOR - reads the input .cam file, creates a list
@@ -236,33 +1241,137 @@ class rgbSensor:
 #
 ###########################################################
 
-def rgbSensorCreator(filename, car, client, dirname, dirprefix, sensorType):
-    world = client.get_world()
-    blueprint = world.get_blueprint_library()
+#Each line is "Name X Y Z Yaw [lidar|radar] [key=value ...]" - lines without a sensor kind are cameras.
+pointCloudKinds = ['lidar', 'radar']
+def parseCrop(value):
+    crop = tuple(int(v) for v in value.split(','))
+    if len(crop) != 4 or min(crop) < 0 or crop[2] == 0 or crop[3] == 0:
+        raise ValueError(value)
+    return crop
+
+def parseSize(value):
+    size = tuple(int(v) for v in value.lower().split('x'))
+    if len(size) != 2 or min(size) <= 0:
+        raise ValueError(value)
+    return size
+
+def parsePool(value):
+    if value not in depthPools:
+        raise ValueError(value)
+    return value
+
+#Optional per-line attributes and their parsers - tick is the CARLA sensor_tick in seconds (0 = every tick),
+#crop=X,Y,W,H and resize=WxH are applied to the raw image before it is encoded.
+sensorAttributes = {"width": int, "height": int, "fov": float, "pitch": float, "roll": float, "tick": float,
+                    "crop": parseCrop, "resize": parseSize, "pool": parsePool}
+cameraOnlyAttributes = ["width", "height", "fov", "crop", "resize", "pool"]
+
+def readSensorFile(filename):
     if os.path.isfile(filename) == False:
         print(".cam file specified does not exist. Please check the path.")
         return
     fp = open(filename)
-    rgbSensorList = []
+    sensorSpecs = []
     linecounter = 0
     for line in fp:
         firstchar = line[0]
-        if firstchar != '#': #If the line is not a comment...
-            args = line.split(" ")
-            if len(args) != 5:
+        if firstchar != '#' and line.strip() != '': #If the line is not a comment...
+            args = [arg for arg in line.split() if '=' not in arg]
+            attributes = [arg.split('=', 1) for arg in line.split() if '=' in arg]
+            if len(args) != 5 and len(args) != 6:
                 print("Incorrect number of arguments on line %i of file %s." % (linecounter, filename))
-                if int(yaw) < 0 or int(yaw) > 359:
+            else:
+                kind = 'camera'
+                if len(args) == 6:
+                    kind = args[5]
+                    if kind not in pointCloudKinds:
+                        print("On line %i, sensor kind should be one of %s." % (linecounter, ", ".join(pointCloudKinds)))
+                        return
+                try:
+                    x, y, z = float(args[1]), float(args[2]), float(args[3])
+                    yaw = int(args[4])
+                except ValueError:
+                    print("On line %i, X Y Z should be numbers and yaw a whole number of degrees." % linecounter)
+                    return
+                if yaw < 0 or yaw > 359:
                     print("On line %i, yaw should be in range 0 to 359." % linecounter)
                     return
-            else:
-                new_sensor = rgbSensor()
-                new_sensor.set_params(float(args[1]), float(args[2]), float(args[3]), int(args[4]))
-                new_sensor.set_meta_params(dirname, dirprefix, args[0])
-                new_sensor.attach_to_car(car, blueprint, world, sensorType)
-                rgbSensorList.append(new_sensor)
+                spec = {"name": args[0], "x": x, "y": y, "z": z, "yaw": yaw, "kind": kind,
+                        "width": 0, "height": 0, "fov": 0.0, "pitch": 0.0, "roll": 0.0, "tick": 0.0,
+                        "crop": None, "resize": None, "pool": 'min'}
+                for key, value in attributes:
+                    if key not in sensorAttributes:
+                        print("On line %i, unknown attribute %s - expected one of %s." % (linecounter, key, ", ".join(sensorAttributes)))
+                        return
+                    if kind != 'camera' and key in cameraOnlyAttributes:
+                        print("On line %i, %s only applies to cameras." % (linecounter, key))
+                        return
+                    try:
+                        spec[key] = sensorAttributes[key](value)
+                    except ValueError:
+                        print("On line %i, invalid value %s for %s." % (linecounter, value, key))
+                        return
+                    if key in ["width", "height", "fov", "tick"] and spec[key] < 0:
+                        print("On line %i, %s should not be negative." % (linecounter, key))
+                        return
+                if spec["crop"] is not None:
+                    imageWidth = spec["width"] or defaultImageSize[0]
+                    imageHeight = spec["height"] or defaultImageSize[1]
+                    if spec["crop"][0] + spec["crop"][2] > imageWidth or spec["crop"][1] + spec["crop"][3] > imageHeight:
+                        print("On line %i, crop %s does not fit in the %ix%i image." % (linecounter, ",".join(str(v) for v in spec["crop"]), imageWidth, imageHeight))
+                        return
+                if (spec["crop"] is not None or spec["resize"] is not None) and Image is None:
+                    print("On line %i, crop and resize need the PIL package to encode images." % linecounter)
+                    return
+                sensorSpecs.append(spec)
         linecounter = linecounter + 1
+    fp.close()
+    return sensorSpecs
+
+def rgbSensorCreator(filename, car, client, dirname, dirprefix, sensorType, index=None, logName='', condName=''):
+    if isinstance(dirname, outputPlacer):
+        dirname.startCondition()
+    world = client.get_world()
+    blueprint = world.get_blueprint_library()
+    sensorSpecs = readSensorFile(filename)
+    if sensorSpecs is None:
+        return
+    rgbSensorList = []
+    for spec in sensorSpecs:
+        if spec["kind"] != 'camera':
+            continue
+        new_sensor = rgbSensor()
+        new_sensor.set_params(spec["x"], spec["y"], spec["z"], spec["yaw"], spec["pitch"], spec["roll"])
+        new_sensor.set_sensor_params(spec["width"], spec["height"], spec["fov"], spec["tick"])
+        if spec["crop"] is not None or spec["resize"] is not None:
+            new_sensor.set_output_params(spec["crop"], spec["resize"], spec["pool"])
+        new_sensor.set_meta_params(placeOutput(dirname, (dirprefix, spec["name"]), sensorWriteWeight(spec)), dirprefix, spec["name"])
+        new_sensor.set_index(index, logName, condName)
+        new_sensor.attach_to_car(car, blueprint, world, sensorType)
+        rgbSensorList.append(new_sensor)
     return rgbSensorList
 
+def pointCloudSensorCreator(filename, car, client, dirname, logName, index=None):
+    if isinstance(dirname, outputPlacer):
+        dirname.startCondition()
+    world = client.get_world()
+    blueprint = world.get_blueprint_library()
+    sensorSpecs = readSensorFile(filename)
+    if sensorSpecs is None:
+        return
+    pointCloudSensorList = []
+    for spec in sensorSpecs:
+        if spec["kind"] not in pointCloudKinds:
+            continue
+        new_sensor = pointCloudSensor()
+        new_sensor.set_params(spec["x"], spec["y"], spec["z"], spec["yaw"], spec["pitch"], spec["roll"])
+        new_sensor.set_sensor_params(spec["tick"])
+        new_sensor.set_meta_params(placeOutput(dirname, (logName, 'PointCloud', spec["name"]), sensorWriteWeight(spec)), logName, spec["name"])
+        new_sensor.set_index(index)
+        new_sensor.attach_to_car(car, blueprint, world, spec["kind"])
+        pointCloudSensorList.append(new_sensor)
+    return pointCloudSensorList
+
 ###########################################################
 #
 # IMAGE SAVER - saves images using multi-threading for 
@@ -270,7 +1379,7 @@ def rgbSensorCreator(filename, car, client, dirname, dirprefix, sensorType):
 #
 ###########################################################
 
-def rgbSaver(sensorList, frameNumber, maxThreads):
+def rgbSaver(sensorList, frameNumber, maxThreads, worldFrame):
     numSensors = len(sensorList)
     numFullThreads = int(numSensors / maxThreads)
     threadRemainder = numSensors % maxThreads
@@ -279,7 +1388,7 @@ def rgbSaver(sensorList, frameNumber, maxThreads):
         for j in range(0, numFullThreads):
             threads = list()
             for i in range(0, maxThreads):
-                thread = threading.Thread(target = sensorList[sensorCounter].saveImage, args=(frameNumber,))
+                thread = threading.Thread(target = sensorList[sensorCounter].saveImage, args=(frameNumber, worldFrame))
                 threads.append(thread)
                 sensorCounter = sensorCounter + 1
                 thread.start()
@@ -288,7 +1397,7 @@ def rgbSaver(sensorList, frameNumber, maxThreads):
     if threadRemainder > 0:
         threads = list()
         for i in range(0, threadRemainder):
-            thread = threading.Thread(target = sensorList[sensorCounter].saveImage, args=(frameNumber,))
+            thread = threading.Thread(target = sensorList[sensorCounter].saveImage, args=(frameNumber, worldFrame))
             threads.append(thread)
             sensorCounter = sensorCounter + 1
             thread.start()
@@ -302,25 +1411,31 @@ def rgbSaver(sensorList, frameNumber, maxThreads):
 #
 ##############################################################
 
-def runCondition(condName, condWeather, condLights, logFile, logFileName, logFrames, sensorFile, sensorDir, sensorType, threadNumber, client):
+def runCondition(condName, condWeather, condLights, logFile, logFileName, logFrames, sensorFile, sensorDir, sensorType, threadNumber, client, index=None, metrics=None, watchdog=None, warmStart=False, collectStats=False):
 
     dirprefix = '%s/%s' % (logFileName, condName)
 
     #Turn on synchronous mode
     settings = client.get_world().get_settings()
     settings.synchronous_mode = True
-    settings.fixed_delta_seconds = 0.10
+    settings.fixed_delta_seconds = fixedDeltaSeconds
     client.get_world().apply_settings(settings)
 
-    for i in range(0,5):
-        client.get_world().tick()
-        time.sleep(0.1)
+    if warmStart:
+        #Start the replay past the spawn animation - sensors are only attached from there, so no
+        #frames are rendered for the skipped ticks.
+        tickWorld(client, watchdog)
+        client.replay_file(logFile, warmStartSeconds(), 0, 0)
+    else:
+        for i in range(0,5):
+            tickWorld(client, watchdog)
+            time.sleep(0.1)
 
-    #Replay the log file
-    client.replay_file(logFile, 0, 0, 0)
+        #Replay the log file
+        client.replay_file(logFile, 0, 0, 0)
 
     #time.sleep(5)
-    client.get_world().tick()
+    tickWorld(client, watchdog)
     actorList = client.get_world().get_actors()
 
     #Find the hero vehicle and attach the sensors.
@@ -333,9 +1448,9 @@ def runCondition(condName, condWeather, condLights, logFile, logFileName, logFra
     if egoVehicle == None:
         print("Error: Could not find the ego vehicle!")
         return
-    sensorList = rgbSensorCreator(sensorFile, egoVehicle, client, sensorDir, dirprefix, sensorType)
+    sensorList = rgbSensorCreator(sensorFile, egoVehicle, client, sensorDir, dirprefix, sensorType, index, logFileName, condName)
 
-    client.get_world().tick()
+    tickWorld(client, watchdog)
 
     #Set the weather and manage the headlights.
     if sensorType == 'rgb':
@@ -349,22 +1464,42 @@ def runCondition(condName, condWeather, condLights, logFile, logFileName, logFra
         for vehicle in vehicleList:
             vehicle.set_light_state(carla.VehicleLightState(lightState))
 
-    #Wait 20 frames for vehicles to spawn to skip spawn animation.
-    for i in range(0, 20):
-        client.get_world().tick()
-        time.sleep(0.1)
+    #Warm starts need no settling time - saveImage matches images to the tick by frame id.
+    if not warmStart:
+        #Wait 20 frames for vehicles to spawn to skip spawn animation.
+        for i in range(0, spawnSkipTicks()):
+            tickWorld(client, watchdog)
+            time.sleep(0.1)
     
-    #Sleep here is required to prevent buffering problem - buffer will read from previous step rather than current.
-    time.sleep(2)
+        #Sleep here is required to prevent buffering problem - buffer will read from previous step rather than current.
+        time.sleep(2)
+
+    stats = None
+    if collectStats:
+        stats = conditionStatistics()
 
     #Start saving data.
     for sensor in sensorList:
+        sensor.set_metrics(metrics)
+        sensor.set_stats(stats)
         sensor.listen() 
+    captureTicks = captureTickCount(logFrames)
+    if metrics is not None:
+        metrics.startCondition(condName, captureTicks, sensorList)
 
     #Wait for the running log to finish, skipping delete animation.
-    for frameNumber in range (0,int(logFrames/2)-40):
-        client.get_world().tick()
-        rgbSaver(sensorList, frameNumber, int(threadNumber))
+    for frameNumber in range (0,captureTicks):
+        worldFrame = tickWorld(client, watchdog)
+        rgbSaver(sensorList, frameNumber, int(threadNumber), worldFrame)
+        if index is not None:
+            index.flush(egoVehicle.get_transform(), frameNumber)
+        if metrics is not None:
+            metrics.frameDone()
+    if captureTicks > 0:
+        for sensor in sensorList:
+            sensor.saveLate(captureTicks - 1)
+    if index is not None:
+        index.flush()
 
     #World should be asynchronous again - server timeout if no tick received in synchronous mode.
     settings = client.get_world().get_settings()
@@ -372,11 +1507,20 @@ def runCondition(condName, condWeather, condLights, logFile, logFileName, logFra
     settings.fixed_delta_seconds = 0
     client.get_world().apply_settings(settings)
 
+    if metrics is not None:
+        metrics.endCondition()
+    if stats is not None:
+        statsDir = '%s/%s' % (primaryRoot(sensorDir), dirprefix)
+        if not(os.path.exists(statsDir)):
+            os.makedirs(statsDir)
+        stats.save('%s/stats.json' % statsDir)
     for sensor in sensorList:
         sensor.destroy()
 
     #Reload world so any static objects moved are returned.
     client.reload_world()
+    if watchdog is not None:
+        watchdog.reset()
 
 ###########################################################
 #
@@ -414,7 +1558,8 @@ class weatherCondition:
         print("    Weather:", self.weather)
         print("    Headlights: ", self.headlights)
         
-def weatherListConstructor(filename):
+#Parses and validates the weather file without touching carla, so a run can be planned without a server.
+def readWeatherFile(filename):
     if os.path.isfile(filename) == False:
         print("Weather .csv file specified does not exist. Please check the path.")
         return
@@ -428,16 +1573,20 @@ def weatherListConstructor(filename):
                 print("Error: expected 11 arguments on line %i of weather file." % lineCount)
                 return
             Name = args[0]
-            cloudiness = float(args[1])
-            precipitation = float(args[2])
-            precipitation_deposits = float(args[3])
-            wind_intensity = float(args[4])
-            fog_density = float(args[5])
-            fog_distance = float(args[6])
-            wetness = float(args[7])
-            sun_azimuth_angle = float(args[8])
-            sun_altitude_angle = float(args[9])
-            headlights = float(args[10])
+            try:
+                cloudiness = float(args[1])
+                precipitation = float(args[2])
+                precipitation_deposits = float(args[3])
+                wind_intensity = float(args[4])
+                fog_density = float(args[5])
+                fog_distance = float(args[6])
+                wetness = float(args[7])
+                sun_azimuth_angle = float(args[8])
+                sun_altitude_angle = float(args[9])
+                headlights = float(args[10])
+            except ValueError:
+                print("Line %i: Weather values should be numbers." % lineCount)
+                return
             if (cloudiness > 100 or cloudiness < 0):
                 print("Line %i: Clouds should be in range 0 < clouds < 100." % lineCount)
                 return
@@ -465,24 +1614,32 @@ def weatherListConstructor(filename):
             if (sun_altitude_angle > 90 or sun_altitude_angle < -90):
                 print("Line %i: Altitude should be in range -90 < altitude < 90." % lineCount)
                 return
-            weather = carla.WeatherParameters(
-                cloudiness = cloudiness,
-                precipitation = precipitation,
-	        precipitation_deposits = precipitation_deposits,
-	        wind_intensity = wind_intensity,
-                fog_density = fog_density,
-                fog_distance = fog_distance,
-                wetness = wetness,
-	        sun_azimuth_angle = sun_azimuth_angle,
-	        sun_altitude_angle = sun_altitude_angle)
-            newCondition = weatherCondition()
-            newCondition.setName(Name)
-            newCondition.setWeather(weather)
-            newCondition.setHeadlights(headlights)
-            weatherList.append(newCondition)
+            weatherList.append({"name": Name, "headlights": headlights, "params": {
+                "cloudiness": cloudiness,
+                "precipitation": precipitation,
+                "precipitation_deposits": precipitation_deposits,
+                "wind_intensity": wind_intensity,
+                "fog_density": fog_density,
+                "fog_distance": fog_distance,
+                "wetness": wetness,
+                "sun_azimuth_angle": sun_azimuth_angle,
+                "sun_altitude_angle": sun_altitude_angle}})
         lineCount = lineCount + 1
     return weatherList
 
+def weatherListConstructor(filename):
+    weatherSpecs = readWeatherFile(filename)
+    if weatherSpecs is None:
+        return
+    weatherList = []
+    for spec in weatherSpecs:
+        newCondition = weatherCondition()
+        newCondition.setName(spec["name"])
+        newCondition.setWeather(carla.WeatherParameters(**spec["params"]))
+        newCondition.setHeadlights(spec["headlights"])
+        weatherList.append(newCondition)
+    return weatherList
+
 ###########################################################
 #
 # getLogTime/Name - returns the length of a log file in seconds/name
@@ -508,6 +1665,114 @@ def getLogMap(logFile, client):
     MapString = logFileInfo[1].split(" ")
     return MapString[1]
 
+###########################################################
+#
+# RUN PLANNER - validates the input files and projects the size
+# and duration of a run without a simulator.
+#
+###########################################################
+
+#Rough figures for planning only - PNG bytes per pixel by camera type and the blueprint defaults.
+estimatedBytesPerPixel = {'rgb': 1.6, 'seg': 0.1, 'depth': 0.9}
+defaultPointsPerSecond = {'lidar': 56000, 'radar': 1500}
+pointCloudChannels = 4
+gpsRecordBytes = 220
+#Warm-up ticks, sleeps and the world reload around each condition, with and without --warm_start.
+conditionOverheadSeconds = 10.0
+warmStartOverheadSeconds = 5.0
+
+def readRecorderString(fp):
+    length = struct.unpack('<H', fp.read(2))[0]
+    return fp.read(length).decode('utf-8', 'replace').rstrip('\x00')
+
+#Reads the map and duration from the recorder file itself - the header, then the elapsed time of the
+#last frame packet. Returns None if the file is not in the expected format.
+def readRecorderInfo(logFile):
+    try:
+        with open(logFile, 'rb') as fp:
+            fp.read(2) #Version
+            if readRecorderString(fp) != 'CARLA_RECORDER':
+                return None
+            fp.read(8) #Date
+            mapName = readRecorderString(fp)
+            duration = 0.0
+            while True:
+                header = fp.read(5)
+                if len(header) < 5:
+                    break
+                packetId, size = struct.unpack('<BI', header)
+                if packetId == 0:
+                    frameId, durationThis, elapsed = struct.unpack('<Qdd', fp.read(24))
+                    duration = elapsed
+                    fp.seek(size - 24, 1)
+                else:
+                    fp.seek(size, 1)
+            return mapName, duration
+    except (OSError, struct.error):
+        return None
+
+def cameraOutputSize(spec):
+    if spec["resize"] is not None:
+        return spec["resize"]
+    if spec["crop"] is not None:
+        return (spec["crop"][2], spec["crop"][3])
+    return (spec["width"] or defaultImageSize[0], spec["height"] or defaultImageSize[1])
+
+def sensorFires(spec, captureTicks):
+    if spec["tick"] <= 0:
+        return captureTicks
+    period = max(1, int(round(spec["tick"] / fixedDeltaSeconds)))
+    return int(math.ceil(captureTicks / float(period)))
+
+#Relative bytes a sensor writes per tick, so least_loaded can weigh one large full rate camera against
+#several small or slow ones.
+def sensorWriteWeight(spec):
+    firesPerTick = sensorFires(spec, 1000) / 1000.0
+    if spec["kind"] == 'camera':
+        width, height = cameraOutputSize(spec)
+        return width * height * firesPerTick
+    return defaultPointsPerSecond[spec["kind"]] * max(spec["tick"], fixedDeltaSeconds) * pointCloudChannels * firesPerTick
+
+#Returns (name, ticks, files, bytes, seconds) for every condition a run would capture.
+def planRun(sensorSpecs, weatherSpecs, logDuration, truth, tickTime, overheadSeconds):
+    captureTicks = captureTickCount(int(logDuration * 20))
+    cameraSpecs = [spec for spec in sensorSpecs if spec["kind"] == 'camera']
+    pointCloudSpecs = [spec for spec in sensorSpecs if spec["kind"] in pointCloudKinds]
+    conditions = []
+    if truth:
+        conditions.append(('GPS', 'gps'))
+        conditions.append(('Semantic', 'seg'))
+        conditions.append(('Depth', 'depth'))
+    for spec in weatherSpecs:
+        conditions.append((spec["name"], 'rgb'))
+    plan = []
+    for condName, sensorType in conditions:
+        numFiles = 0
+        numBytes = 0.0
+        if sensorType == 'gps':
+            numFiles = captureTicks
+            numBytes = captureTicks * (gpsRecordBytes + imuDtype.itemsize + gnssDtype.itemsize)
+            for spec in pointCloudSpecs:
+                points = defaultPointsPerSecond[spec["kind"]] * max(spec["tick"], fixedDeltaSeconds)
+                numBytes = numBytes + sensorFires(spec, captureTicks) * points * pointCloudChannels * 4
+        else:
+            for spec in cameraSpecs:
+                width, height = cameraOutputSize(spec)
+                fires = sensorFires(spec, captureTicks)
+                numFiles = numFiles + fires
+                numBytes = numBytes + fires * width * height * estimatedBytesPerPixel[sensorType]
+        plan.append((condName, captureTicks, numFiles, numBytes, captureTicks * tickTime + overheadSeconds))
+    return plan
+
+def printPlan(plan, logFile, mapName, logDuration):
+    print("PLAN for LOGFILE %s (map %s, %.1f s)" % (logFile, mapName, logDuration))
+    print("%-24s %8s %10s %12s %10s" % ("Condition", "Ticks", "Files", "Disk (MB)", "Time (s)"))
+    totals = [0, 0, 0.0, 0.0]
+    for condName, ticks, numFiles, numBytes, seconds in plan:
+        print("%-24s %8i %10i %12.1f %10.0f" % (condName, ticks, numFiles, numBytes / 1e6, seconds))
+        totals = [totals[0] + ticks, totals[1] + numFiles, totals[2] + numBytes, totals[3] + seconds]
+    print("%-24s %8i %10i %12.1f %10.0f" % ("TOTAL", totals[0], totals[1], totals[2] / 1e6, totals[3]))
+
 ###########################################################
 #
 # Batch destroy actors - taken from generateFreeDrivingLog.py
@@ -556,8 +1821,14 @@ def main():
 	help='.csv file of all of the desired weather scenarios to run.')
     argparser.add_argument(
 	'--dir',
-	default='./output',
-	help='Directory output images will be saved to.')
+	default=['./output'],
+	nargs='+',
+	help='Directories output images will be saved to. Sensors are spread over several directories (e.g. one per disk) by --placement, the frame index is kept in the first.')
+    argparser.add_argument(
+        '--placement',
+        default='round_robin',
+        choices=placementPolicies,
+        help='How sensors are spread over several --dir roots - least_loaded balances their expected write rate (default: round_robin)')
     argparser.add_argument(
         '--sensors',
         default='nil',
@@ -575,9 +1846,88 @@ def main():
 	'-t', '--max_threads',
 	default=3,
 	help='Maximum number of threads that can be used to render images (default: 1)')
+    argparser.add_argument(
+        '--index',
+        default='index.db',
+        help='Frame index database, relative to --dir. Set to nil to disable (default: index.db)')
+    argparser.add_argument(
+        '--metrics_port',
+        default=0,
+        type=int,
+        help='Serve live capture metrics in Prometheus text format on this local port, 0 to disable (default: 0)')
+    argparser.add_argument(
+        '--metrics_interval',
+        default=60,
+        type=float,
+        help='Seconds between progress lines on stderr, 0 to disable (default: 60)')
+    argparser.add_argument(
+        '--timeout',
+        default=100.0,
+        type=float,
+        help='Simulator RPC timeout in seconds (default: 100)')
+    argparser.add_argument(
+        '--stall_factor',
+        default=10.0,
+        type=float,
+        help='A tick is treated as stalled once it takes this many times the recent median tick time (default: 10)')
+    argparser.add_argument(
+        '--min_tick_timeout',
+        default=5.0,
+        type=float,
+        help='Lower bound on the stalled tick timeout in seconds (default: 5)')
+    argparser.add_argument(
+        '--retries',
+        default=2,
+        type=int,
+        help='Number of times a failed condition is retried after reconnecting (default: 2)')
+    argparser.add_argument(
+        '--reconnect_wait',
+        default=600.0,
+        type=float,
+        help='Seconds to wait for the simulator to come back before giving up (default: 600)')
+    argparser.add_argument(
+        '--imu_tick',
+        default=0.0,
+        type=float,
+        help='sensor_tick of the IMU and GNSS streams in seconds, 0 for every world tick. Streams cannot run faster than --delta (default: 0)')
+    argparser.add_argument(
+        '--delta',
+        default=0.10,
+        type=float,
+        help='Synchronous mode world step in seconds. Lower it for high rate IMU/GNSS and give cameras a tick= to keep their rate (default: 0.1)')
+    argparser.add_argument(
+        '--warm_start',
+        default=0,
+        type=int,
+        help='Flag to start each replay past the spawn animation instead of ticking and sleeping through it.')
+    argparser.add_argument(
+        '--stats',
+        default=0,
+        type=int,
+        help='Flag to write per-condition stats.json summaries (class histograms, depth ranges, brightness, GPS track length).')
+    argparser.add_argument(
+        '--plan',
+        default=0,
+        type=int,
+        help='Flag to validate the input files and print the projected size and run time without connecting to a server.')
+    argparser.add_argument(
+        '--log_duration',
+        default=0.0,
+        type=float,
+        help='Log duration in seconds for --plan, read from the .log file if not given.')
+    argparser.add_argument(
+        '--plan_tick_time',
+        default=0.5,
+        type=float,
+        help='Wall-clock seconds per capture tick assumed by --plan (default: 0.5)')
     args = argparser.parse_args()
 
     #Check args.
+    if args.delta <= 0:
+        print("--delta must be positive.")
+        return
+    global fixedDeltaSeconds
+    fixedDeltaSeconds = args.delta
     if os.path.isfile(args.logfile) == False:
         print(".log file specified does not exist. Please check the path.")
         return
@@ -588,17 +1938,58 @@ def main():
         print("Weather .csv file specified does not exist. Please check the path.")
         return
 
+    #Validate the sensor and weather files up front, rather than after the truth passes.
+    sensorSpecs = readSensorFile(args.sensors)
+    weatherSpecs = readWeatherFile(args.weather_parameters)
+    if sensorSpecs is None or weatherSpecs is None:
+        return
+
+    if bool(args.plan):
+        logDuration = args.log_duration
+        mapName = 'unknown'
+        recorderInfo = readRecorderInfo(args.logfile)
+        if recorderInfo is not None:
+            mapName = recorderInfo[0]
+            if logDuration <= 0:
+                logDuration = recorderInfo[1]
+        if logDuration <= 0:
+            print("Could not read the duration of the .log file - pass it with --log_duration.")
+            return
+        overheadSeconds = conditionOverheadSeconds
+        if bool(args.warm_start):
+            overheadSeconds = warmStartOverheadSeconds
+        printPlan(planRun(sensorSpecs, weatherSpecs, logDuration, bool(args.truth), args.plan_tick_time, overheadSeconds), args.logfile, mapName, logDuration)
+        return
+
+    importCarla()
+    weatherConditionList = weatherListConstructor(args.weather_parameters)
+
+    for root in args.dir:
+        if not(os.path.exists(root)):
+            os.makedirs(root)
+    placer = outputPlacer(args.dir, args.placement)
+
+    #Open the frame index - appended to by every run into the same --dir.
+    index = None
+    if args.index != 'nil':
+        index = frameIndex(os.path.join(args.dir[0], args.index), args.dir)
+
+    metrics = captureMetrics(args.metrics_interval)
+    if args.metrics_port > 0:
+        metrics.serve(args.metrics_port)
+
     #Create the Carla client.
     #os.system(". /vol/teaching/drive_weather/run_carla")
-    client = carla.Client(args.host, args.port)
-    client.set_timeout(100.0)
+    watchdog = tickWatchdog(args.timeout, args.min_tick_timeout, args.stall_factor)
+    session = simulatorSession(args.host, args.port, args.timeout, args.reconnect_wait, watchdog)
+    client = session.client
 
     #Get recorder file info.
     logFileName = getLogName(args.logfile)
     logFrames = getLogFrames(args.logfile, client)
     logMap = getLogMap(args.logfile, client)
     #Load world to prevent sync issue on first condition.
-    client.load_world(logMap)
+    session.loadMap(logMap)
     
     print("----------------")
     print("BEGIN LOGFILE %s, SENSORFILE %s at %s" % (args.logfile,args.sensors, datetime.datetime.now()))
@@ -606,17 +1997,24 @@ def main():
     dfltWthr = client.get_world().get_weather()
 
     #Run truth conditions - GPS, Semantic and Depth
-    if bool(args.truth):
-        runGPS(args.logfile, logFileName, logFrames, args.dir, client)
-        runCondition('Semantic', dfltWthr, False, args.logfile, logFileName, logFrames, args.sensors, args.dir, 'seg', args.max_threads, client)
-        runCondition('Depth', dfltWthr, False, args.logfile, logFileName, logFrames, args.sensors, args.dir, 'depth', args.max_threads, client)
-        print("Completed Truth at %s" % datetime.datetime.now())
-
-    weatherConditionList = weatherListConstructor(args.weather_parameters)
-    for weather in weatherConditionList:
-        runCondition(weather.getName(), weather.getWeather(), weather.getHeadlights(), args.logfile, logFileName, logFrames, args.sensors, args.dir, 'rgb', args.max_threads, client)
-        print("Condition: %s completed at time %s." % (weather.getName(), datetime.datetime.now()))
-
+    try:
+        if bool(args.truth):
+            runWithRetry('GPS', lambda client: runGPS(args.logfile, logFileName, logFrames, placer, args.sensors, client, index, metrics, watchdog, args.imu_tick, bool(args.warm_start), bool(args.stats)), session, args.retries, index, logFileName)
+            runWithRetry('Semantic', lambda client: runCondition('Semantic', dfltWthr, False, args.logfile, logFileName, logFrames, args.sensors, placer, 'seg', args.max_threads, client, index, metrics, watchdog, bool(args.warm_start), bool(args.stats)), session, args.retries, index, logFileName)
+            runWithRetry('Depth', lambda client: runCondition('Depth', dfltWthr, False, args.logfile, logFileName, logFrames, args.sensors, placer, 'depth', args.max_threads, client, index, metrics, watchdog, bool(args.warm_start), bool(args.stats)), session, args.retries, index, logFileName)
+            print("Completed Truth at %s" % datetime.datetime.now())
+
+        for weather in weatherConditionList:
+            completed = runWithRetry(weather.getName(), lambda client: runCondition(weather.getName(), weather.getWeather(), weather.getHeadlights(), args.logfile, logFileName, logFrames, args.sensors, placer, 'rgb', args.max_threads, client, index, metrics, watchdog, bool(args.warm_start), bool(args.stats)), session, args.retries, index, logFileName)
+            if completed:
+                print("Condition: %s completed at time %s." % (weather.getName(), datetime.datetime.now()))
+    finally:
+        #Never leave the server in synchronous mode - it would block until the next client ticks it.
+        restoreAsync(session.client)
+
+    if index is not None:
+        index.close()
+    metrics.close()
     print("End processing at %s" % datetime.datetime.now())
 
 if __name__ == '__main__':
@@ -0,0 +1,234 @@
+import glob
+import os
+import argparse
+import json
+import sqlite3
+import threading
+import time
+import collections
+import concurrent.futures
+
+import numpy as np
+from PIL import Image
+
+###########################################################
+#
+# DATASET READER - iterates over (log, condition, frame)
+# samples written by captureData.py, joining every camera
+# with the GPS/IMU record and lidar/radar scans for the frame.
+#
+###########################################################
+
+#Cache of decoded frames keyed by file path, least recently used evicted first.
+class frameCache:
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        if self.maxSize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+def decodeImage(filename):
+    with Image.open(filename) as image:
+        return np.asarray(image)
+
+def decodeGPS(filename):
+    with open(filename) as infile:
+        return json.load(infile)
+
+#Point clouds are read straight out of the per-run .bin file, the .json beside it gives the channel count.
+def decodePointCloud(filename, offset, size):
+    with open(filename[:-len('.bin')] + '.json') as infile:
+        header = json.load(infile)
+    points = np.fromfile(filename, dtype=np.float32, count=int(size / 4), offset=offset)
+    return points.reshape(-1, max(1, header["channels"]))
+
+#IMU/GNSS streams are raw records, the .json beside the file holds the numpy dtype description.
+def readSensorStream(filename):
+    with open(filename[:-len('.bin')] + '.json') as infile:
+        descr = json.load(infile)["dtype"]
+    dtype = np.dtype([tuple(field[:2]) + tuple(tuple(shape) for shape in field[2:]) for field in descr])
+    return np.fromfile(filename, dtype=dtype)
+
+class datasetReader:
+    def __init__(self, root, index='index.db', logs=None, conditions=None, cameras=None, prefetch=8, workers=4, cacheSize=256):
+        #Capture may be striped over several roots - the index in the first one covers all of them.
+        if isinstance(root, str):
+            root = [root]
+        self.roots = root
+        self.prefetch = max(1, int(prefetch))
+        self.workers = max(1, int(workers))
+        self.cache = frameCache(cacheSize)
+        indexPath = os.path.join(self.roots[0], index)
+        if os.path.isfile(indexPath):
+            records = self.readIndex(indexPath)
+        else:
+            records = []
+            for root in self.roots:
+                records.extend(self.readTree(root))
+        self.buildSamples(records, logs, conditions, cameras)
+
+    #Records are (log, condition, camera, frame, path, offset, size) tuples, GPS and lidar/radar
+    #records use the conditions 'GPS' and 'PointCloud'. Row paths are relative to their output root, which
+    #the roots table gives relative to the index - older indexes without it are relative to the index.
+    #A root that has been moved or remounted only needs its row in the roots table updated.
+    def readIndex(self, indexPath):
+        indexRoot = os.path.dirname(os.path.abspath(indexPath))
+        conn = sqlite3.connect(indexPath)
+        if 'root' in [column[1] for column in conn.execute('PRAGMA table_info(frames)')]:
+            rows = conn.execute('SELECT f.log, f.condition, f.camera, f.frame, f.path, f.offset, f.size, r.path '
+                                'FROM frames f LEFT JOIN roots r ON f.root = r.id').fetchall()
+        else:
+            rows = conn.execute('SELECT log, condition, camera, frame, path, offset, size, NULL FROM frames').fetchall()
+        conn.close()
+        return [(log, cond, cam, frame, os.path.normpath(os.path.join(indexRoot, root or '', path)), offset, size) for (log, cond, cam, frame, path, offset, size, root) in rows]
+
+    def readTree(self, root):
+        records = []
+        for filename in glob.glob(os.path.join(root, '*', 'GPS', '*.txt')):
+            parts = filename.split(os.sep)
+            records.append((parts[-3], 'GPS', 'GPS', int(parts[-1].split('.')[0]), filename, 0, 0))
+        for filename in glob.glob(os.path.join(root, '*', 'PointCloud', '*.offsets.npy')):
+            parts = filename.split(os.sep)
+            name = parts[-1][:-len('.offsets.npy')]
+            binFile = os.path.join(os.path.dirname(filename), name + '.bin')
+            with open(os.path.join(os.path.dirname(filename), name + '.json')) as infile:
+                channels = json.load(infile)["channels"]
+            for (frame, offset, numPoints) in np.load(filename):
+                records.append((parts[-3], 'PointCloud', name, int(frame), binFile, int(offset), int(numPoints) * channels * 4))
+        for filename in glob.glob(os.path.join(root, '*', '*', '*', '*.png')):
+            parts = filename.split(os.sep)
+            records.append((parts[-4], parts[-3], parts[-2], int(parts[-1].split('.')[0]), filename, 0, 0))
+        return records
+
+    def buildSamples(self, records, logs, conditions, cameras):
+        gpsFiles = {}
+        pointFiles = {}
+        sampleFiles = {}
+        for (log, cond, cam, frame, path, offset, size) in records:
+            if logs is not None and log not in logs:
+                continue
+            if cond == 'GPS':
+                gpsFiles[(log, frame)] = path
+                continue
+            if cond == 'PointCloud':
+                pointFiles.setdefault((log, frame), {})[cam] = (path, offset, size)
+                continue
+            if conditions is not None and cond not in conditions:
+                continue
+            if cameras is not None and cam not in cameras:
+                continue
+            sampleFiles.setdefault((log, cond, frame), {})[cam] = path
+        self.gpsFiles = gpsFiles
+        self.pointFiles = pointFiles
+        self.sampleFiles = sampleFiles
+        self.sampleKeys = sorted(sampleFiles.keys())
+
+    def __len__(self):
+        return len(self.sampleKeys)
+
+    def samples(self):
+        return list(self.sampleKeys)
+
+    def loadFile(self, filename, decoder):
+        data = self.cache.get(filename)
+        if data is None:
+            data = decoder(filename)
+            self.cache.put(filename, data)
+        return data
+
+    def loadSample(self, key):
+        log, cond, frame = key
+        images = {}
+        for cam, path in self.sampleFiles[key].items():
+            images[cam] = self.loadFile(path, decodeImage)
+        gps = None
+        if (log, frame) in self.gpsFiles:
+            gps = self.loadFile(self.gpsFiles[(log, frame)], decodeGPS)
+        points = {}
+        for name, (path, offset, size) in self.pointFiles.get((log, frame), {}).items():
+            points[name] = decodePointCloud(path, offset, size)
+        return {'log': log, 'condition': cond, 'frame': frame, 'images': images, 'gps': gps, 'points': points}
+
+    def __getitem__(self, i):
+        return self.loadSample(self.sampleKeys[i])
+
+    #Samples are decoded by the worker pool, keeping up to self.prefetch of them in flight ahead of the consumer.
+    def __iter__(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = collections.deque()
+            keys = iter(self.sampleKeys)
+            while True:
+                while len(pending) < self.prefetch:
+                    key = next(keys, None)
+                    if key is None:
+                        break
+                    pending.append(pool.submit(self.loadSample, key))
+                if len(pending) == 0:
+                    return
+                yield pending.popleft().result()
+
+###########################################################
+#
+# MAIN - reads a dataset and reports throughput
+#
+###########################################################
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description=__doc__)
+    argparser.add_argument(
+        '--dir',
+        default=['./output'],
+        nargs='+',
+        help='Directories the dataset was captured to, the first holding the frame index.')
+    argparser.add_argument(
+        '--index',
+        default='index.db',
+        help='Frame index database, relative to --dir. The output tree is walked if it does not exist (default: index.db)')
+    argparser.add_argument(
+        '--prefetch',
+        default=8,
+        type=int,
+        help='Number of samples decoded ahead of the consumer (default: 8)')
+    argparser.add_argument(
+        '-t', '--max_threads',
+        default=4,
+        type=int,
+        help='Number of decode threads (default: 4)')
+    args = argparser.parse_args()
+
+    for root in args.dir:
+        if os.path.isdir(root) == False:
+            print("Dataset directory %s does not exist. Please check the path." % root)
+            return
+
+    reader = datasetReader(args.dir, args.index, prefetch=args.prefetch, workers=args.max_threads)
+    startTime = time.time()
+    numBytes = 0
+    for sample in reader:
+        for image in sample['images'].values():
+            numBytes = numBytes + image.nbytes
+    elapsed = max(time.time() - startTime, 1e-6)
+    print("Read %i samples in %.2f s (%.1f samples/s, %.1f MB/s decoded)." % (len(reader), elapsed, len(reader) / elapsed, numBytes / elapsed / 1e6))
+
+if __name__ == '__main__':
+
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass